@@ -1,26 +1,48 @@
 # Standard Library
 import sqlite3
 import datetime
-import re
 import threading
+import csv
+import importlib.util
+import io
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 # Third-Party Libraries
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask.views import MethodView
 from flask_cors import CORS
 import streamlit as st
 
+DEFAULT_USER_ID = 'anonymous'
+# 新規作成時のシャード数（作成後はカタログのsettingsに保存された値を使う）
+SHARD_COUNT = 4
+
+def parse_watermark(since):
+    # 保存値はローカル時刻（タイムゾーンなし）なので、オフセット付きの値はローカル時刻に変換して揃える
+    watermark = datetime.datetime.fromisoformat(since)
+    if watermark.tzinfo is not None:
+        watermark = watermark.astimezone().replace(tzinfo=None)
+    return watermark.isoformat(sep=' ')
+
 class DatabaseManager:
-    def __init__(self, db_path, logger):
+    def __init__(self, db_path, logger, read_only=False):
         self.db_path = db_path
         self.logger = logger
+        self.read_only = read_only
         self.conn = None
         self.cursor = None
 
     def connect(self):
         try:
             self.logger.info(f"Connecting to database at {self.db_path}...")
-            self.conn = sqlite3.connect(self.db_path)
+            if self.read_only:
+                # 読み取り専用接続（エクスポートなどで書き込み側をブロックしないため）
+                self.conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            else:
+                self.conn = sqlite3.connect(self.db_path)
             self.cursor = self.conn.cursor()
             self.logger.info("Database connected successfully.")
         except sqlite3.Error as e:
@@ -49,12 +71,77 @@ class DatabaseManager:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close(commit=exc_type is None)
 
+#Route watch data to per-user shard databases.
+class ShardRouter:
+    # シャード数は作成後に変わらないので、カタログごとに一度だけ読み込む
+    shard_counts = {}
+
+    def __init__(self, logger, db_path):
+        # db_pathは動画・チャンネルの共有カタログ、視聴時間はユーザーごとにシャードへ分散する
+        self.logger = logger
+        self.db_path = db_path
+        self.shard_count = self.load_shard_count()
+
+    def load_shard_count(self):
+        if self.db_path not in self.shard_counts:
+            with DatabaseManager(self.db_path, self.logger, read_only=True) as db:
+                db.cursor.execute("SELECT value FROM settings WHERE key = 'shard_count'")
+                result = db.cursor.fetchone()
+                if result is None:
+                    raise ValueError(f"Shard count is not recorded in {self.db_path}")
+                self.shard_counts[self.db_path] = int(result[0])
+        return self.shard_counts[self.db_path]
+
+    def shard_paths(self):
+        root, ext = os.path.splitext(self.db_path)
+        return [f"{root}_shard{index}{ext}" for index in range(self.shard_count)]
+
+    def shard_path(self, user_id):
+        # プロセスをまたいでも同じシャードになるよう、hash()ではなくcrc32を使う
+        index = zlib.crc32(user_id.encode('utf-8')) % self.shard_count
+        return self.shard_paths()[index]
+
+    def map_shards(self, func, shard_paths=None):
+        shard_paths = shard_paths or self.shard_paths()
+        with ThreadPoolExecutor(max_workers=len(shard_paths)) as executor:
+            return list(executor.map(func, shard_paths))
+
+    def total_watch_times(self, video_ids, user_id=None):
+        if not video_ids:
+            return {}
+
+        placeholders = ', '.join('?' for _ in video_ids)
+        query = f'''
+        SELECT video_id, SUM(total_watch_time)
+        FROM video_watch_times
+        WHERE video_id IN ({placeholders})
+        '''
+        params = list(video_ids)
+        if user_id:
+            query += 'AND user_id = ? '
+            params.append(user_id)
+        query += 'GROUP BY video_id'
+
+        def shard_totals(shard_path):
+            with DatabaseManager(shard_path, self.logger, read_only=True) as db:
+                db.cursor.execute(query, params)
+                return db.cursor.fetchall()
+
+        shard_paths = [self.shard_path(user_id)] if user_id else None
+        totals = {video_id: 0 for video_id in video_ids}
+        for rows in self.map_shards(shard_totals, shard_paths):
+            for video_id, total_watch_time in rows:
+                totals[video_id] += total_watch_time
+        return totals
+
 class DatabaseInitializer:
     @classmethod
-    def create_tables(cls, db_path, logger):
+    def create_tables(cls, db_path, logger, shard_count=SHARD_COUNT):
         db_manager = DatabaseManager(db_path, logger)
         with db_manager as db:
             try:
+                # WALモードにすることで、読み取り中でも書き込みがブロックされない
+                db.cursor.execute('PRAGMA journal_mode=WAL')
                 db.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS videos (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -74,23 +161,141 @@ class DatabaseInitializer:
                     date_retrieved DATE NOT NULL
                 )
                 ''')
+                db.cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_channel_table_id ON videos(channel_table_id)')
+                db.cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_video_url ON videos(video_url)')
+                db.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+                ''')
+                # シャード数はデータの配置を決めるので、最初に作成したときの値を保存して使い続ける
+                db.cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('shard_count', ?)", (shard_count,))
+                db.cursor.execute("SELECT value FROM settings WHERE key = 'shard_count'")
+                stored_shard_count = int(db.cursor.fetchone()[0])
+                if stored_shard_count != shard_count:
+                    logger.warning(f"Using stored shard count {stored_shard_count} instead of {shard_count}")
+                cls.create_search_index(db)
+                logger.info("Database initialized successfully.")
+            except sqlite3.Error as e:
+                logger.error(f"An error occurred: {e}")
+                st.error(f"An error occurred: {e}")
+                raise
+
+        router = ShardRouter(logger, db_path)
+        for shard_path in router.shard_paths():
+            cls.create_shard_tables(shard_path, logger)
+        cls.migrate_legacy_watch_times(router, logger)
+
+    @classmethod
+    def create_shard_tables(cls, shard_path, logger):
+        # video_idはカタログ側のvideos(id)を参照する（別ファイルのため外部キーは張れない）
+        with DatabaseManager(shard_path, logger) as db:
+            try:
+                db.cursor.execute('PRAGMA journal_mode=WAL')
                 db.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS video_watch_times (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
                     video_id INTEGER NOT NULL,
                     total_watch_time INTEGER DEFAULT 0,
                     date_retrieved DATE NOT NULL,
-                    FOREIGN KEY(video_id) REFERENCES videos(id)
+                    UNIQUE(user_id, video_id)
                 )
                 ''')
-                logger.info("Database initialized successfully.")
+                db.cursor.execute('CREATE INDEX IF NOT EXISTS idx_video_watch_times_video_id ON video_watch_times(video_id)')
+                db.cursor.execute('CREATE INDEX IF NOT EXISTS idx_video_watch_times_date_retrieved ON video_watch_times(date_retrieved)')
+                logger.info(f"Shard database initialized successfully: {shard_path}")
             except sqlite3.Error as e:
                 logger.error(f"An error occurred: {e}")
                 st.error(f"An error occurred: {e}")
                 raise
 
+    @classmethod
+    def migrate_legacy_watch_times(cls, router, logger):
+        # 旧スキーマ（カタログ内のvideo_watch_times）のデータをデフォルトユーザーのシャードへ移す
+        with DatabaseManager(router.db_path, logger) as db:
+            db.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'video_watch_times'")
+            if db.cursor.fetchone() is None:
+                return
+
+        logger.info("Migrating legacy watch times to shard databases...")
+        with DatabaseManager(router.shard_path(DEFAULT_USER_ID), logger) as db:
+            try:
+                db.cursor.execute('ATTACH DATABASE ? AS catalog', (router.db_path,))
+                # 旧スキーマは同じvideo_idの行が複数ある場合があるので合算する
+                # 合算値で上書きするため、途中で失敗して再実行しても二重に加算されない
+                db.cursor.execute('''
+                INSERT INTO video_watch_times (user_id, video_id, total_watch_time, date_retrieved)
+                SELECT ?, video_id, SUM(total_watch_time), MAX(date_retrieved)
+                FROM catalog.video_watch_times
+                WHERE true
+                GROUP BY video_id
+                ON CONFLICT(user_id, video_id) DO UPDATE SET
+                    total_watch_time = excluded.total_watch_time,
+                    date_retrieved = excluded.date_retrieved
+                ''', (DEFAULT_USER_ID,))
+                db.conn.commit()
+                # 元データは削除せずにリネームして残す
+                db.cursor.execute('ALTER TABLE catalog.video_watch_times RENAME TO video_watch_times_legacy')
+                logger.info("Legacy watch times migrated successfully.")
+            except sqlite3.Error as e:
+                logger.error(f"An error occurred while migrating watch times: {e}")
+                st.error(f"An error occurred while migrating watch times: {e}")
+                raise
+
+    @classmethod
+    def create_search_index(cls, db):
+        # 全文検索用のFTS5インデックス（元テーブルの内容をトリガーで同期する）
+        # 日本語は単語区切りがないため、trigramで部分一致できるようにする
+        # trigramは3文字未満の語を検索できないので、短い語用にunicode61の前方一致インデックスも作る
+        trigram_options = "tokenize='trigram'"
+        prefix_options = "tokenize='unicode61 remove_diacritics 2', prefix='1 2'"
+        search_tables = [
+            ('videos_fts', 'videos', 'video_title', trigram_options),
+            ('channels_fts', 'channels', 'channel_name', trigram_options),
+            ('videos_prefix_fts', 'videos', 'video_title', prefix_options),
+            ('channels_prefix_fts', 'channels', 'channel_name', prefix_options),
+        ]
+        for fts_table, content_table, column, options in search_tables:
+            db.cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,))
+            result = db.cursor.fetchone()
+            exists = result is not None
+            if exists and options not in result[0]:
+                # 設定の異なる古いインデックスは作り直す
+                db.cursor.execute(f'DROP TABLE {fts_table}')
+                exists = False
+            db.cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                {column},
+                content='{content_table}',
+                content_rowid='id',
+                {options}
+            )
+            ''')
+            db.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {content_table} BEGIN
+                INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+            END
+            ''')
+            db.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {content_table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            END
+            ''')
+            db.cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF {column} ON {content_table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column});
+            END
+            ''')
+            if not exists:
+                # 既存データをインデックスに取り込む
+                db.cursor.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}})
+# 埋め込みプレイヤーからの送信のみ許可する（/exportは他サイトから読み取れないようにする）
+CORS(app, resources={r"/save_watch_time": {"origins": "*"}})
 
 class StartFlask:
     def __init__(self, logger, port_number):
@@ -125,6 +330,14 @@ class ChannelManager:
                 return result
             else:
                 return None
+
+    def channel_id_search_many(self, channel_ids):
+        if not channel_ids:
+            return {}
+        placeholders = ', '.join('?' for _ in channel_ids)
+        with DatabaseManager(self.db_path, self.logger) as db:
+            db.cursor.execute(f'SELECT channel_id, id FROM channels WHERE channel_id IN ({placeholders})', list(channel_ids))
+            return dict(db.cursor.fetchall())
                 
     def insert_channel(self, channel_name, channel_id, channel_url, date_retrieved):
         with DatabaseManager(self.db_path, self.logger) as db:
@@ -164,73 +377,401 @@ class VideoManager:
                 st.error(f"An error occurred: {e}")
                 raise
 
+    @classmethod
+    def insert_videos(cls, logger, db_path, videos):
+        # videos: (video_title, channel_table_id, video_url, date_retrieved) のリストを1トランザクションで挿入する
+        with DatabaseManager(db_path, logger) as db:
+            try:
+                db.cursor.executemany('''
+                INSERT INTO videos (video_title, channel_table_id, video_url, date_retrieved)
+                VALUES (?, ?, ?, ?)
+                ''', videos)
+                logger.info(f'{len(videos)} videos inserted successfully')
+            except sqlite3.Error as e:
+                logger.error(f"An error occurred: {e}")
+                st.error(f"An error occurred: {e}")
+                raise
+
 class DbIdVideoManager:
     def __init__(self, logger, db_path):
         self.logger = logger
         self.db_path = db_path
 
-    def get_video_id(self, video_url):
-        youtube_video_id = re.search(r'embed/([^&]+)', video_url).group(1)
-        video_url = f"https://www.youtube.com/watch?v={youtube_video_id}"
+    def get_video_ids(self, youtube_video_ids):
+        # 登録済みの動画だけを {YouTubeの動画ID: データベースID} で返す（同じURLが複数あれば最新のもの）
+        if not youtube_video_ids:
+            return {}
+        video_urls = {f"https://www.youtube.com/watch?v={youtube_video_id}": youtube_video_id for youtube_video_id in youtube_video_ids}
+        placeholders = ', '.join('?' for _ in video_urls)
         with DatabaseManager(self.db_path, self.logger) as db:
             try:
-                db.cursor.execute('''
-                SELECT id FROM videos 
-                WHERE video_url = ? 
-                ORDER BY date_retrieved DESC 
-                LIMIT 1
-                ''', (video_url,))
-                result = db.cursor.fetchone()
-                if result:
-                    self.logger.info(f"This video database ID is founded: {result[0]}")
-                    return result[0]
-                else:
-                    raise ValueError(f"No video found for URL: {video_url}")
+                db.cursor.execute(f'''
+                SELECT video_url, id FROM videos
+                WHERE video_url IN ({placeholders})
+                ORDER BY date_retrieved
+                ''', list(video_urls))
+                return {video_urls[video_url]: video_db_id for video_url, video_db_id in db.cursor.fetchall()}
             except sqlite3.Error as e:
                 self.logger.error(f"An error occurred while querying the database: {e}")
                 st.error(f"An error occurred while querying the database: {e}")
                 raise
 
+class VideoSearchManager:
+    def __init__(self, logger, db_path):
+        self.logger = logger
+        self.db_path = db_path
+        self.router = ShardRouter(logger, db_path)
+
+    @staticmethod
+    def build_search_terms(query):
+        # 各単語をフレーズに変換する（FTS5の構文エラーを防ぐ）
+        # 3文字以上の語はtrigramで部分一致、3文字未満の語はunicode61の前方一致で検索する
+        # （短い語は単語の先頭にしか一致しないため、日本語では文の途中の語は見つからない）
+        terms = [term.replace('"', '') for term in query.split()]
+        terms = [term for term in terms if term]
+        match_query = ' '.join(f'"{term}"' for term in terms if len(term) >= 3)
+        prefix_query = ' '.join(f'"{term}"*' for term in terms if len(term) < 3)
+        return match_query, prefix_query
+
+    @staticmethod
+    def build_source(fts_table, prefix_table, match_query, prefix_query):
+        # どちらの条件もインデックスで絞り込めるように、検索するFTSテーブルと条件を選ぶ
+        if not match_query:
+            return prefix_table, f'{prefix_table} MATCH :prefix'
+        condition = f'{fts_table} MATCH :match'
+        if prefix_query:
+            # +rowidとすることで、前方一致の結果を一度だけ取得して絞り込む（行ごとにMATCHを再実行させない）
+            condition += f' AND +rowid IN (SELECT rowid FROM {prefix_table} WHERE {prefix_table} MATCH :prefix)'
+        return fts_table, condition
+
+    def search(self, query, page=1, page_size=20, user_id=None):
+        match_query, prefix_query = self.build_search_terms(query)
+        if not match_query and not prefix_query:
+            return [], False
+
+        title_table, title_condition = self.build_source('videos_fts', 'videos_prefix_fts', match_query, prefix_query)
+        channel_table, channel_condition = self.build_source('channels_fts', 'channels_prefix_fts', match_query, prefix_query)
+        params = {
+            'match': match_query,
+            'prefix': prefix_query,
+            'top': (page - 1) * page_size + page_size + 1,
+            'limit': page_size + 1,
+            'offset': (page - 1) * page_size,
+        }
+
+        with DatabaseManager(self.db_path, self.logger, read_only=True) as db:
+            try:
+                # タイトルとチャンネル名それぞれの上位だけをbm25順に取り出してからまとめる
+                db.cursor.execute(f'''
+                WITH title_matches AS (
+                    SELECT rowid AS video_id, rank
+                    FROM {title_table}
+                    WHERE {title_condition}
+                    ORDER BY rank, rowid
+                    LIMIT :top
+                ),
+                channel_matches AS (
+                    SELECT v.id AS video_id, matched.rank
+                    FROM (
+                        SELECT rowid, rank
+                        FROM {channel_table}
+                        WHERE {channel_condition}
+                        ORDER BY rank, rowid
+                        LIMIT :top
+                    ) AS matched
+                    JOIN videos v ON v.channel_table_id = matched.rowid
+                ),
+                ranked AS (
+                    SELECT video_id, MIN(rank) AS rank
+                    FROM (
+                        SELECT video_id, rank FROM title_matches
+                        UNION ALL
+                        SELECT video_id, rank FROM channel_matches
+                    )
+                    GROUP BY video_id
+                    ORDER BY rank, video_id
+                    LIMIT :limit OFFSET :offset
+                )
+                SELECT v.id, v.video_title, v.video_url, c.channel_name
+                FROM ranked
+                JOIN videos v ON v.id = ranked.video_id
+                LEFT JOIN channels c ON c.id = v.channel_table_id
+                ORDER BY ranked.rank, ranked.video_id
+                ''', params)
+                rows = db.cursor.fetchall()
+            except sqlite3.Error as e:
+                self.logger.error(f"An error occurred while searching: {e}")
+                st.error(f"An error occurred while searching: {e}")
+                raise
+
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        # 視聴時間は各シャードから並列に集計する（user_id指定時はそのユーザーのシャードのみ）
+        totals = self.router.total_watch_times([row[0] for row in rows], user_id)
+        results = [
+            {
+                'id': row[0],
+                'video_title': row[1],
+                'video_url': row[2],
+                'channel_name': row[3],
+                'total_watch_time': totals[row[0]],
+            }
+            for row in rows
+        ]
+        self.logger.info(f"Search '{query}' page {page}: {len(results)} results")
+        return results, has_next
+
 class WatchTimeAPI(MethodView):
     def __init__(self, logger, db_path):
         self.logger = logger
         self.db_path = db_path
+        self.router = ShardRouter(logger, db_path)
 
     def get(self):
         try:
             video_id = request.args.get('video_id')
             watch_time = request.args.get('watch_time')
+            user_id = request.args.get('user_id') or DEFAULT_USER_ID
         
             if not video_id or not watch_time:
                 self.logger.error('Missing video_id or watch_time')
                 return jsonify({'status': 'error', 'message': 'Missing video_id or watch_time'}), 400
             
-            return self.save_watch_time(video_id, watch_time)
+            return self.save_watch_time(user_id, video_id, watch_time)
 
         except Exception as e:
             self.logger.error(f"An error occurred: {e}")
             st.error(f"An error occurred: {e}")
             raise
 
-    def save_watch_time(self, video_id, watch_time):
-        with DatabaseManager(self.db_path, self.logger) as db:
+    def save_watch_time(self, user_id, video_id, watch_time):
+        # ユーザーごとのシャードに書き込むため、ロックはシャード単位で競合する
+        shard_path = self.router.shard_path(user_id)
+        with DatabaseManager(shard_path, self.logger) as db:
             try:
-                db.cursor.execute('SELECT total_watch_time FROM video_watch_times WHERE video_id = ?', (video_id,))
-                result = db.cursor.fetchone()
                 date_retrieved = datetime.datetime.now()
+                db.cursor.execute('''
+                INSERT INTO video_watch_times (user_id, video_id, total_watch_time, date_retrieved)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, video_id) DO UPDATE SET
+                    total_watch_time = total_watch_time + excluded.total_watch_time,
+                    date_retrieved = excluded.date_retrieved
+                ''', (user_id, video_id, float(watch_time), date_retrieved))
+                db.cursor.execute('SELECT total_watch_time FROM video_watch_times WHERE user_id = ? AND video_id = ?', (user_id, video_id))
+                total_watch_time = db.cursor.fetchone()[0]
+                self.logger.info(f'user_id: {user_id}, video_id: {video_id}, total_watch_time: {total_watch_time}')
 
-                if result:
-                    total_watch_time = result[0] + float(watch_time)
-                    db.cursor.execute('UPDATE video_watch_times SET total_watch_time = ?, date_retrieved = ? WHERE video_id = ?', (total_watch_time, date_retrieved, video_id))
-                else:
-                    total_watch_time = float(watch_time)
-                    self.logger.info(f'video_id: {video_id}')
-                    self.logger.info(f'total_watch_time: {total_watch_time}')
-                    db.cursor.execute('INSERT INTO video_watch_times (video_id, total_watch_time, date_retrieved) VALUES (?, ?, ?)', (video_id, total_watch_time, date_retrieved))
-                    
-                return jsonify({'status': 'success', 'video_id': video_id, 'total_watch_time': total_watch_time})
+                return jsonify({'status': 'success', 'user_id': user_id, 'video_id': video_id, 'total_watch_time': total_watch_time})
             
             except sqlite3.Error as e:
                 self.logger.error(f"An error occurred: {e}")
                 st.error(f"An error occurred: {e}")
-                return jsonify({'status': 'error', 'message': str(e)}), 500
\ No newline at end of file
+                return jsonify({'status': 'error', 'message': str(e)}), 500
+
+#Export watch history in chunks.
+class WatchTimeExporter:
+    FORMATS = {
+        'csv': 'text/csv',
+        'jsonl': 'application/x-ndjson',
+        'parquet': 'application/vnd.apache.parquet',
+    }
+    # 各シャードのidは重複するため出力せず、(user_id, video_id)を行のキーとする
+    COLUMNS = [
+        'user_id',
+        'video_id',
+        'video_title',
+        'video_url',
+        'channel_name',
+        'channel_id',
+        'channel_url',
+        'total_watch_time',
+        'date_retrieved',
+    ]
+    # 書き込みは時刻を取得してからコミットするまでに最大でsqlite3のbusy timeout（5秒）待つことがあるため、
+    # それより新しい行は今回の出力に含めず、次回の出力に回す
+    WATERMARK_GRACE = datetime.timedelta(seconds=10)
+
+    def __init__(self, logger, db_path, chunk_size=1000, user_id=None):
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive integer")
+        self.logger = logger
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.user_id = user_id
+        self.router = ShardRouter(logger, db_path)
+        # シャードごとに読み取る時刻が異なっても取りこぼさないよう、出力範囲の上限を最初に決めておく
+        # 次回の出力ではこの値をsinceとして渡す
+        self.until = (datetime.datetime.now() - self.WATERMARK_GRACE).isoformat(sep=' ')
+
+    def iter_chunks(self, since=None):
+        # fetchmanyでチャンクごとに読み込むため、テーブルサイズに関係なくメモリ使用量は一定
+        query = '''
+        SELECT vwt.user_id, v.id, v.video_title, v.video_url,
+               c.channel_name, c.channel_id, c.channel_url,
+               vwt.total_watch_time, vwt.date_retrieved
+        FROM video_watch_times vwt
+        JOIN catalog.videos v ON v.id = vwt.video_id
+        LEFT JOIN catalog.channels c ON c.id = v.channel_table_id
+        WHERE vwt.date_retrieved <= ?
+        '''
+        params = [self.until]
+        if since:
+            # 保存時と同じ形式に揃えて文字列として比較する
+            watermark = parse_watermark(since)
+            query += 'AND vwt.date_retrieved > ? '
+            params.append(watermark)
+        if self.user_id:
+            query += 'AND vwt.user_id = ? '
+            params.append(self.user_id)
+        query += 'ORDER BY vwt.date_retrieved, vwt.id'
+
+        if self.user_id:
+            shard_paths = [self.router.shard_path(self.user_id)]
+        else:
+            shard_paths = self.router.shard_paths()
+
+        # シャードを順に読み、動画・チャンネル情報はカタログをATTACHして結合する
+        for shard_path in shard_paths:
+            with DatabaseManager(shard_path, self.logger, read_only=True) as db:
+                try:
+                    db.cursor.execute('ATTACH DATABASE ? AS catalog', (f"file:{self.db_path}?mode=ro",))
+                    db.cursor.execute(query, params)
+                    while True:
+                        rows = db.cursor.fetchmany(self.chunk_size)
+                        if not rows:
+                            break
+                        yield rows
+                except sqlite3.Error as e:
+                    self.logger.error(f"An error occurred while exporting: {e}")
+                    raise
+
+    @staticmethod
+    def parquet_available():
+        # ストリーミング開始後に失敗しないよう、出力前にpyarrowの有無を確認する
+        return importlib.util.find_spec('pyarrow') is not None
+
+    def iter_csv(self, since=None):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.COLUMNS)
+        for rows in self.iter_chunks(since):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    def iter_jsonl(self, since=None):
+        for rows in self.iter_chunks(since):
+            yield ''.join(
+                json.dumps(dict(zip(self.COLUMNS, row)), ensure_ascii=False) + '\n'
+                for row in rows
+            )
+
+    def iter_parquet(self, since=None):
+        # pyarrowはParquet出力時のみ必要
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ValueError("Parquet export requires pyarrow to be installed") from e
+
+        schema = pa.schema([
+            ('user_id', pa.string()),
+            ('video_id', pa.int64()),
+            ('video_title', pa.string()),
+            ('video_url', pa.string()),
+            ('channel_name', pa.string()),
+            ('channel_id', pa.string()),
+            ('channel_url', pa.string()),
+            ('total_watch_time', pa.float64()),
+            ('date_retrieved', pa.string()),
+        ])
+        sink = _ChunkSink()
+        writer = pq.ParquetWriter(sink, schema)
+        try:
+            # チャンクごとに1つのrow groupとして書き出す
+            for rows in self.iter_chunks(since):
+                columns = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                    schema=schema,
+                ))
+                yield sink.drain()
+        finally:
+            writer.close()
+        yield sink.drain()
+
+    def iter_export(self, export_format, since=None):
+        if export_format == 'csv':
+            return self.iter_csv(since)
+        elif export_format == 'jsonl':
+            return self.iter_jsonl(since)
+        elif export_format == 'parquet':
+            return self.iter_parquet(since)
+        else:
+            raise ValueError(f"Unsupported export format: {export_format}")
+
+class _ChunkSink(io.RawIOBase):
+    # ParquetWriterの出力を溜めておき、チャンクごとに取り出すためのバッファ
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+class ExportAPI(MethodView):
+    def __init__(self, logger, db_path):
+        self.logger = logger
+        self.db_path = db_path
+
+    def get(self):
+        export_format = request.args.get('format', 'csv')
+        since = request.args.get('since')
+        user_id = request.args.get('user_id')
+
+        if export_format not in WatchTimeExporter.FORMATS:
+            self.logger.error(f'Unsupported export format: {export_format}')
+            return jsonify({'status': 'error', 'message': f'Unsupported export format: {export_format}'}), 400
+
+        if export_format == 'parquet' and not WatchTimeExporter.parquet_available():
+            self.logger.error('Parquet export requires pyarrow to be installed')
+            return jsonify({'status': 'error', 'message': 'Parquet export requires pyarrow to be installed'}), 501
+
+        try:
+            chunk_size = int(request.args.get('chunk_size', 1000))
+            if chunk_size <= 0:
+                raise ValueError("chunk_size must be a positive integer")
+            if since:
+                parse_watermark(since)
+        except ValueError:
+            self.logger.error('Invalid chunk_size or since')
+            return jsonify({'status': 'error', 'message': 'Invalid chunk_size or since'}), 400
+
+        self.logger.info(f'Exporting watch history as {export_format} since {since} for user {user_id}')
+        exporter = WatchTimeExporter(self.logger, self.db_path, chunk_size, user_id)
+        return Response(
+            exporter.iter_export(export_format, since),
+            mimetype=WatchTimeExporter.FORMATS[export_format],
+            headers={
+                'Content-Disposition': f'attachment; filename=watch_history.{export_format}',
+                'X-Export-Watermark': exporter.until,
+            },
+        )
\ No newline at end of file
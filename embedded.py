@@ -1,10 +1,12 @@
+import json
+
 import streamlit.components.v1 as components
 
 class Embedded:
     def __init__(self, logger):
         self.logger = logger
 
-    def video_html(self, video_db_id, video_url, port_number):
+    def video_html(self, video_db_id, video_url, port_number, user_id):
         components.html(f"""
         <html>
         <body>
@@ -15,6 +17,7 @@ class Embedded:
                 var videoUrl = "{video_url}";
                 var videoId = "{video_db_id}"; 
                 var port = "{port_number}";
+                var userId = {json.dumps(user_id)};
                 console.log(videoUrl);
                 console.log(videoId);
                 console.log(port);
@@ -56,7 +59,7 @@ class Embedded:
                             var endTime = new Date().getTime();
                             var elapsed = (endTime - startTime) / 1000;
                             watchTime += elapsed;
-                            fetch(`http://localhost:${{port}}/save_watch_time?video_id=${{videoId}}&watch_time=${{watchTime}}`)
+                            fetch(`http://localhost:${{port}}/save_watch_time?video_id=${{videoId}}&watch_time=${{watchTime}}&user_id=${{encodeURIComponent(userId)}}`)
                                 .then(response => {{
                                     if (!response.ok) {{
                                         throw new Error('Network response was not ok');
@@ -87,4 +90,5 @@ class Embedded:
         """, height=400)
         self.logger.info(f'Video URL: {video_url} from embedded.py')
         self.logger.info(f'Video ID: {video_db_id} from embedded.py')
-        self.logger.info(f'Port number: {port_number} from embedded.py')
\ No newline at end of file
+        self.logger.info(f'Port number: {port_number} from embedded.py')
+        self.logger.info(f'User ID: {user_id} from embedded.py')
\ No newline at end of file
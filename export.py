@@ -0,0 +1,58 @@
+# Standard Library
+import argparse
+import logging
+import sys
+
+# Local Module
+from services.database import WatchTimeExporter, parse_watermark
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("must be a positive integer")
+    return number
+
+def watermark(value):
+    try:
+        parse_watermark(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be an ISO 8601 timestamp")
+    return value
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export watch history from the SQLite database.")
+    parser.add_argument('db_path', help="Path to the SQLite database")
+    parser.add_argument('--format', choices=sorted(WatchTimeExporter.FORMATS), default='csv', help="Output format")
+    parser.add_argument('--since', type=watermark, help="Only export rows updated after this timestamp (ISO 8601); use the watermark printed by the previous export")
+    parser.add_argument('--user-id', help="Only export watch history of this user")
+    parser.add_argument('--chunk-size', type=positive_int, default=1000, help="Number of rows fetched per chunk")
+    parser.add_argument('--output', '-o', help="Output file (default: stdout)")
+    args = parser.parse_args()
+    if args.format == 'parquet' and not WatchTimeExporter.parquet_available():
+        parser.error("Parquet export requires pyarrow to be installed")
+    return args
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    logger = logging.getLogger(__name__)
+
+    exporter = WatchTimeExporter(logger, args.db_path, args.chunk_size, args.user_id)
+    chunks = exporter.iter_export(args.format, args.since)
+
+    if args.format == 'parquet':
+        output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    else:
+        output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+    # 次回の差分出力では、この値を--sinceに指定する
+    logger.info(f"Export finished. Next watermark: {exporter.until}")
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -2,6 +2,8 @@
 import re
 import socket
 import datetime
+from collections import namedtuple
+from urllib.parse import unquote
 
 # Third-Party Library
 import streamlit as st
@@ -9,9 +11,59 @@ import streamlit as st
 # Local Module
 from services.database import (
     ChannelManager,
+    DbIdVideoManager,
     VideoManager,
 )
 
+# kind: "video" / "channel" / "playlist"
+# handleは/@名と/c/のカスタム名、usernameは旧形式の/user/名（両者は別のチャンネルを指すことがある）
+ParsedURL = namedtuple(
+    'ParsedURL',
+    ['kind', 'video_id', 'channel_id', 'handle', 'playlist_id', 'username'],
+    defaults=[None, None, None, None, None],
+)
+
+# 1つの正規表現で全形式のURLを判定し、必要なIDを一度に取り出す
+URL_PATTERN = re.compile(r'''
+    ^(?:https?://)?(?:(?:www|m|music)\.)?
+    (?:(?=[^#]*?[?&]list=(?P<playlist_id>[\w-]+)))?
+    (?:
+        youtu\.be/(?P<short_id>[\w-]{11})(?![\w-])
+      | youtube(?:-nocookie)?\.com/
+        (?:
+            watch/?\?(?:[^#]*?&)?v=(?P<watch_id>[\w-]{11})(?![\w-])
+          | (?:shorts|live|embed|v)/(?!videoseries)(?P<path_id>[\w-]{11})(?![\w-])
+          | (?:playlist|embed/videoseries)/?\?
+          | channel/(?P<channel_id>[\w-]+)
+          | @(?P<handle>[\w.%-]+)
+          | user/(?P<username>[\w.%-]+)
+          | c/(?P<custom>[\w.%-]+)
+        )
+    )
+''', re.VERBOSE)
+
+def parse_url(url):
+    match = URL_PATTERN.match(url.strip())
+    if not match:
+        return None
+
+    groups = match.groupdict()
+    video_id = groups['short_id'] or groups['watch_id'] or groups['path_id']
+    # 日本語などのハンドルはパーセントエンコードされていることがある
+    # /c/のカスタムURLは旧ユーザー名ではないため、ハンドルと同じ方法で解決する
+    handle = groups['handle'] or groups['custom']
+    handle = unquote(handle) if handle else None
+    username = unquote(groups['username']) if groups['username'] else None
+    if video_id:
+        kind = "video"
+    elif groups['channel_id'] or handle or username:
+        kind = "channel"
+    elif groups['playlist_id']:
+        kind = "playlist"
+    else:
+        return None
+    return ParsedURL(kind, video_id, groups['channel_id'], handle, groups['playlist_id'], username)
+
 def find_free_port(logger):
     try:
         logger.info("Finding free port...")
@@ -32,26 +84,13 @@ def find_free_port(logger):
 
 class URLChecker:
     def __init__(self, logger):
-        try:
-            self.logger = logger
-            self.channel_patterns = [
-                re.compile(r'(https?://)?(www\.)?(youtube\.com|youtu\.?be)/channel/'),
-                re.compile(r'(https?://)?(www\.)?(youtube\.com|youtu\.?be)/@'),
-                re.compile(r'(https?://)?(www\.)?(youtube\.com|youtu\.?be)/user/')
-            ]
-            self.video_pattern = re.compile(r'(https?://)?(www\.)?(youtube\.com|youtu\.?be)/watch\?v=')
-        except Exception as e:
-            self.logger.error(f"Error initializing URLChecker: {e}", exc_info=True)
-            st.error(f"Error initializing URLChecker: {e}")
-            raise e
+        self.logger = logger
 
     def check_url(self, url):
         try:
-            for pattern in self.channel_patterns:
-                if pattern.match(url):
-                    return "channel"
-            if self.video_pattern.match(url):
-                return "video"
+            parsed_url = parse_url(url)
+            if parsed_url:
+                return parsed_url
             else:
                 raise ValueError("Invalid URL")
         except Exception as e:
@@ -107,14 +146,40 @@ class YouTubeInfoFetcher:
             st.error(f"Error processing channel information: {e}")
             raise e
 
+    def channel_info_insert_many(self, channel_ids, db_path):
+        try:
+            channel_table_ids = ChannelManager(self.logger, db_path).channel_id_search_many(channel_ids)
+            missing_ids = [channel_id for channel_id in channel_ids if channel_id not in channel_table_ids]
+
+            # 未登録のチャンネルは50件ずつまとめてAPIから取得する
+            for start in range(0, len(missing_ids), 50):
+                response = self.youtube_client.channels().list(
+                    part="snippet",
+                    id=",".join(missing_ids[start:start + 50]),
+                    maxResults=50
+                ).execute()
+                for item in response.get('items', []):
+                    channel_id = item['id']
+                    channel_url = f"https://www.youtube.com/channel/{channel_id}"
+                    channel_table_ids[channel_id] = ChannelManager(self.logger, db_path).insert_channel(
+                        item['snippet']['title'], channel_id, channel_url, datetime.datetime.now()
+                    )
+            self.logger.info(f"Channel table IDs: {channel_table_ids}")
+            return channel_table_ids
+        except Exception as e:
+            self.logger.error(f"Error processing channel information: {e}", exc_info=True)
+            st.error(f"Error processing channel information: {e}")
+            raise e
+
 class VideoProcessor(YouTubeInfoFetcher):
-    def __init__(self, logger, url, youtube_client, db_path):
+    def __init__(self, logger, parsed_url, youtube_client, db_path):
         super().__init__(logger, youtube_client)
         self.logger = logger
-        self.video_url = url
         self.youtube_client = youtube_client
         self.db_path = db_path
-        self.video_id = re.search(r'v=([^&]+)', self.video_url).group(1)
+        self.video_id = parsed_url.video_id
+        # youtu.be/shorts/liveなども同じ形式のURLで保存する
+        self.video_url = f"https://www.youtube.com/watch?v={self.video_id}"
 
     def video_info(self):
         try:
@@ -142,50 +207,61 @@ class VideoProcessor(YouTubeInfoFetcher):
 
     def process_video(self):
         try:
+            # 登録済みの動画は再登録しない（同じ動画の視聴時間が複数のIDに分かれないようにする）
+            if DbIdVideoManager(self.logger, self.db_path).get_video_ids([self.video_id]):
+                self.logger.info(f"Video already exists: {self.video_id}")
+                return [self.video_id]
             video_title, date_retrieved, channel_id = self.video_info()
             if video_title is None or date_retrieved is None or channel_id is None:
                 raise ValueError("Video title, date retrieved, or channel ID is None")
             self.logger.info(f"Video title: {video_title}, Channel ID: {channel_id}, Date retrieved: {date_retrieved}")
             channel_table_id = self.channel_info_insert(channel_id, self.db_path)
             VideoManager(self.logger, self.db_path, video_title, channel_table_id, self.video_url, date_retrieved).insert_video()
-            return [f"https://www.youtube.com/embed/{self.video_id}"]
+            return [self.video_id]
         except Exception as e:
             self.logger.error(f"Error processing video: {e}", exc_info=True)
             st.error(f"Error processing video: {e}")
             raise e
 
 class ChannelProcessor(YouTubeInfoFetcher):
-    def __init__(self, logger, url, youtube_client, db_path):
+    def __init__(self, logger, parsed_url, youtube_client, db_path):
         super().__init__(logger, youtube_client)
         self.logger = logger
-        self.url = url
+        self.parsed_url = parsed_url
         self.youtube_client = youtube_client
         self.db_path = db_path
-        self.channel_id = None
+        self.channel_id = parsed_url.channel_id
 
     def check_channel(self):
-        if 'channel/' in self.url:
-            self.channel_id = re.search(r'channel/([^/?]+)', self.url).group(1)
+        if self.channel_id:
             return self.channel_id
-        elif '@' in self.url:
-            username = re.search(r'@([^/?]+)', self.url).group(1)
-            response = self.youtube_client.search().list(
-                q=username,
-                type="channel",
-                part="id,snippet"
+        elif self.parsed_url.handle:
+            # forHandle/forUsernameで直接引ければsearchより少ないクォータで済む
+            name = self.parsed_url.handle
+            response = self.youtube_client.channels().list(
+                forHandle=name,
+                part="id"
             ).execute()
-            return response['items'][0]['id']['channelId']
-        elif 'user/' in self.url:
-            username = re.search(r'user/([^/?]+)', self.url).group(1)
-            response = self.youtube_client.search().list(
-                q=username,
-                type="channel",
-                part="id,snippet"
+        elif self.parsed_url.username:
+            name = self.parsed_url.username
+            response = self.youtube_client.channels().list(
+                forUsername=name,
+                part="id"
             ).execute()
-            return response['items'][0]['id']['channelId']
         else:
             raise ValueError("Invalid channel URL")
 
+        if response.get('items'):
+            self.channel_id = response['items'][0]['id']
+            return self.channel_id
+        response = self.youtube_client.search().list(
+            q=name,
+            type="channel",
+            part="id,snippet"
+        ).execute()
+        self.channel_id = response['items'][0]['id']['channelId']
+        return self.channel_id
+
     def get_channel_videos(self, channel_id):
         response = self.youtube_client.search().list(
             part='snippet',
@@ -214,28 +290,106 @@ class ChannelProcessor(YouTubeInfoFetcher):
         channel_id = self.check_channel()
         videos = self.get_channel_videos(channel_id)
         channel_table_id = self.channel_info_insert(channel_id, self.db_path)
+        stored_ids = DbIdVideoManager(self.logger, self.db_path).get_video_ids([video['id'] for video in videos])
 
         for video in videos:
+            if video['id'] in stored_ids:
+                continue
             video_title = video['title']
             video_url = video['url']
             date_retrieved = datetime.datetime.now()
             VideoManager(self.logger, self.db_path, video_title, channel_table_id, video_url, date_retrieved).insert_video()
         
-        return [f"https://www.youtube.com/embed/{video['id']}" for video in videos]
+        return [video['id'] for video in videos]
+
+class PlaylistProcessor(YouTubeInfoFetcher):
+    def __init__(self, logger, parsed_url, youtube_client, db_path):
+        super().__init__(logger, youtube_client)
+        self.logger = logger
+        self.playlist_id = parsed_url.playlist_id
+        self.youtube_client = youtube_client
+        self.db_path = db_path
+
+    def get_playlist_pages(self):
+        page_token = None
+        while True:
+            response = self.youtube_client.playlistItems().list(
+                part='snippet',
+                playlistId=self.playlist_id,
+                maxResults=50,
+                pageToken=page_token
+            ).execute()
+
+            videos = []
+            for item in response.get('items', []):
+                snippet = item['snippet']
+                # 非公開・削除済みの動画はチャンネル情報がないので飛ばす
+                if 'videoOwnerChannelId' not in snippet:
+                    continue
+                video_id = snippet['resourceId']['videoId']
+                videos.append({
+                    'title': snippet['title'],
+                    'url': f"https://www.youtube.com/watch?v={video_id}",
+                    'id': video_id,
+                    'channel_id': snippet['videoOwnerChannelId']
+                })
+            yield videos
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+    def process_playlist(self):
+        try:
+            video_ids = []
+            seen_ids = set()
+            for videos in self.get_playlist_pages():
+                # 登録済みの動画とプレイリスト内の重複は挿入しない
+                stored_ids = DbIdVideoManager(self.logger, self.db_path).get_video_ids([video['id'] for video in videos])
+                new_videos = []
+                for video in videos:
+                    if video['id'] in seen_ids:
+                        continue
+                    seen_ids.add(video['id'])
+                    video_ids.append(video['id'])
+                    if video['id'] not in stored_ids:
+                        new_videos.append(video)
+                if not new_videos:
+                    continue
+
+                channel_ids = list(dict.fromkeys(video['channel_id'] for video in new_videos))
+                channel_table_ids = self.channel_info_insert_many(channel_ids, self.db_path)
+                date_retrieved = datetime.datetime.now()
+                VideoManager.insert_videos(self.logger, self.db_path, [
+                    (video['title'], channel_table_ids.get(video['channel_id']), video['url'], date_retrieved)
+                    for video in new_videos
+                ])
+
+            if not video_ids:
+                raise ValueError("No videos found for the given playlist ID")
+            self.logger.info(f"Playlist {self.playlist_id}: {len(video_ids)} videos processed")
+            return video_ids
+        except Exception as e:
+            self.logger.error(f"Error processing playlist: {e}", exc_info=True)
+            st.error(f"Error processing playlist: {e}")
+            raise e
 
 #check URL type and process
 class URLProcessor:
     def __init__(self, logger):
         self.logger = logger
 
-    def process_url(self, url, url_type, youtube_client, db_path):
+    def process_url(self, parsed_url, youtube_client, db_path):
         try:
-            if url_type == "video":
+            if parsed_url.kind == "video":
                 self.logger.info("Processing video URL...")
-                return VideoProcessor(self.logger, url, youtube_client, db_path).process_video()
-            elif url_type == "channel":
+                return VideoProcessor(self.logger, parsed_url, youtube_client, db_path).process_video()
+            elif parsed_url.kind == "channel":
                 self.logger.info("Processing channel URL...")
-                return ChannelProcessor(self.logger, url, youtube_client, db_path).process_channel()
+                return ChannelProcessor(self.logger, parsed_url, youtube_client, db_path).process_channel()
+            elif parsed_url.kind == "playlist":
+                self.logger.info("Processing playlist URL...")
+                return PlaylistProcessor(self.logger, parsed_url, youtube_client, db_path).process_playlist()
             else:
                 raise ValueError("Invalid URL")
         except Exception as e:
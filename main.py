@@ -10,11 +10,14 @@ import services.config as config
 import services.function as func
 from embedded import Embedded as embed
 from services.database import (
+    DEFAULT_USER_ID,
     DatabaseInitializer,
     StartFlask,
     DbIdVideoManager,
+    VideoSearchManager,
     app,
     WatchTimeAPI,
+    ExportAPI,
 )
 
 class CustomFormatter(logging.Formatter):
@@ -74,13 +77,14 @@ class CacheInitialize:
 
 # Main Class
 class YouTubeWatchTimeApp:
-    def __init__(self, logger, cache_initializer, func, embed, DbIdVideoManager):
+    def __init__(self, logger, cache_initializer, func, embed, DbIdVideoManager, VideoSearchManager):
         self.logger = logger
         self.cache_initializer = cache_initializer
         self.db_path = self.cache_initializer.db_path
         self.func = func
         self.embed = embed
         self.DbIdVideoManager = DbIdVideoManager
+        self.VideoSearchManager = VideoSearchManager
 
     @st.cache_resource
     def initialize(_self):
@@ -97,32 +101,82 @@ class YouTubeWatchTimeApp:
         try:
             youtube_client = self.initialize()
             st.title("YouTube-Watch-Time")
+            user_id = st.sidebar.text_input("User ID", value=DEFAULT_USER_ID).strip() or DEFAULT_USER_ID
             url = st.text_input("Enter video or channel URL")
 
             if url:
                 self.logger.info(f"The URL is entered: {url}")
-                self.video_display(url, youtube_client)
+                self.video_display(url, youtube_client, user_id)
+
+            query = st.text_input("Search tracked videos and channels")
+            if query:
+                self.logger.info(f"The search query is entered: {query}")
+                self.search_display(query, user_id)
         except Exception as e:
             self.logger.error(f"Error running YouTubeWatchTimeApp: {e}", exc_info=True)
             st.error(f"Error running app: {e}")
 
-    def video_display(self, url, youtube_client):
+    def search_display(self, query, user_id, page_size=20):
         try:
-            url_type = self.func.URLChecker(self.logger).check_url(url)
-            self.logger.info(f"The URL type is: {url_type}")
-            processed_urls = self.func.URLProcessor(self.logger).process_url(url, url_type, youtube_client, self.db_path)
-
-            self.logger.info(f"Processed URLs: {processed_urls}")
+            page = st.number_input("Page", min_value=1, value=1, step=1)
+            only_mine = st.checkbox("Show only my watch time")
+            results, has_next = self.VideoSearchManager(self.logger, self.db_path).search(
+                query, page, page_size, user_id if only_mine else None
+            )
+
+            if not results:
+                st.info("No matching videos found.")
+                return
+
+            st.dataframe(
+                [
+                    {
+                        "Title": result['video_title'],
+                        "Channel": result['channel_name'],
+                        "Watch time (s)": result['total_watch_time'],
+                        "URL": result['video_url'],
+                    }
+                    for result in results
+                ],
+                use_container_width=True,
+            )
+            if has_next:
+                st.caption(f"Page {page}. More results on the next page.")
+            else:
+                st.caption(f"Page {page}. No more results.")
+        except Exception as e:
+            self.logger.error(f"Error displaying search results from YouTubeWatchTimeApp: {e}", exc_info=True)
+            st.error(f"Error displaying search results from YouTubeWatchTimeApp: {e}")
 
-            for video_url in processed_urls:
-                video_db_id = self.DbIdVideoManager(self.logger, self.db_path).get_video_id(video_url)
-                video_url = f"{video_url}?enablejsapi=1"
+    def video_display(self, url, youtube_client, user_id, page_size=5):
+        try:
+            # ウィジェット操作のたびに再実行されるため、処理済みのURLはAPI呼び出しと登録を繰り返さない
+            processed_urls = st.session_state.setdefault('processed_urls', {})
+            if url not in processed_urls:
+                parsed_url = self.func.URLChecker(self.logger).check_url(url)
+                self.logger.info(f"The parsed URL is: {parsed_url}")
+                processed_urls[url] = self.func.URLProcessor(self.logger).process_url(parsed_url, youtube_client, self.db_path)
+            youtube_video_ids = processed_urls[url]
+
+            self.logger.info(f"Processed video IDs: {youtube_video_ids}")
+
+            # プレイリストなど動画が多い場合は、ページごとに埋め込む
+            if len(youtube_video_ids) > page_size:
+                page_count = (len(youtube_video_ids) + page_size - 1) // page_size
+                page = st.number_input("Video page", min_value=1, max_value=page_count, value=1, step=1)
+                st.caption(f"Page {page} of {page_count} ({len(youtube_video_ids)} videos)")
+                youtube_video_ids = youtube_video_ids[(page - 1) * page_size:page * page_size]
+
+            video_db_ids = self.DbIdVideoManager(self.logger, self.db_path).get_video_ids(youtube_video_ids)
+            for youtube_video_id in youtube_video_ids:
+                video_db_id = video_db_ids[youtube_video_id]
+                video_url = f"https://www.youtube.com/embed/{youtube_video_id}?enablejsapi=1"
 
                 self.logger.info(f"Video database ID: {video_db_id}")
                 self.logger.info(f"Video URL: {video_url}")
                 self.logger.info(f"Flask server port number: {self.cache_initializer.port_number}")
                 
-                self.embed(self.logger).video_html(video_db_id, video_url, self.cache_initializer.port_number)
+                self.embed(self.logger).video_html(video_db_id, video_url, self.cache_initializer.port_number, user_id)
         except Exception as e:
             self.logger.error(f"Error displaying video from YouTubeWatchTimeApp: {e}", exc_info=True)
             st.error(f"Error displaying video from YouTubeWatchTimeApp: {e}")
@@ -133,13 +187,19 @@ def add_watch_time_api_if_not_exists(app, logger, db_path):
         watch_time_view = WatchTimeAPI.as_view('watch_time_api', logger=logger, db_path=db_path)
         app.add_url_rule('/save_watch_time', view_func=watch_time_view, methods=['GET'])
 
+def add_export_api_if_not_exists(app, logger, db_path):
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules()}
+    if 'export_api' not in endpoints:
+        export_view = ExportAPI.as_view('export_api', logger=logger, db_path=db_path)
+        app.add_url_rule('/export', view_func=export_view, methods=['GET'])
+
 @st.cache_resource
 def get_cache_initializer(_logger, DatabaseInitializer, ConfigManager, _find_free_port, StartFlask):
     return CacheInitialize(_logger, DatabaseInitializer, ConfigManager, _find_free_port, StartFlask)
 
 @st.cache_resource
-def get_youtube_watch_time_app(_logger, _cache_initializer, _func, _embed, _DbIdVideoManager):
-    return YouTubeWatchTimeApp(_logger, _cache_initializer, _func, _embed, _DbIdVideoManager)
+def get_youtube_watch_time_app(_logger, _cache_initializer, _func, _embed, _DbIdVideoManager, _VideoSearchManager):
+    return YouTubeWatchTimeApp(_logger, _cache_initializer, _func, _embed, _DbIdVideoManager, _VideoSearchManager)
 
 # Create an instance
 cache_initializer = get_cache_initializer(
@@ -156,8 +216,10 @@ app_instance = get_youtube_watch_time_app(
     func,
     embed,
     DbIdVideoManager,
+    VideoSearchManager,
 )
 
 # Run the app
 add_watch_time_api_if_not_exists(app, logger, cache_initializer.db_path)
+add_export_api_if_not_exists(app, logger, cache_initializer.db_path)
 app_instance.run()
\ No newline at end of file